@@ -1,12 +1,20 @@
-import re
-import tempfile
-import os
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
 import streamlit as st
 import pandas as pd
 import extract_msg
-from email.utils import parseaddr
+from email.message import Message
+from email.parser import BytesHeaderParser
+from email.policy import compat32
+
+try:
+    from fast_mail_parser import parse_email, ParseError
+    _HAVE_FMP = True
+except ImportError:
+    _HAVE_FMP = False
+
+MAX_MSG_BYTES = 50 * 1024 * 1024
 
 st.set_page_config(page_title="MSG Header Analyzer (Enhanced)", layout="wide")
 
@@ -28,22 +36,26 @@ uploaded_files = st.file_uploader(
     "Dateien hochladen (.msg oder .eml)", type=["msg", "eml"], accept_multiple_files=True
 )
 
-def extract_from_eml(raw: bytes) -> str:
-    try:
-        text = raw.decode("utf-8", errors="ignore")
-    except:
-        text = raw.decode("latin1", errors="ignore")
-    # return header section only (before the first blank line)
-    return text.split("\\n\\n", 1)[0]
+def parse_eml(raw: bytes) -> Message:
+    # liest nur den Header-Block (bis zur ersten Leerzeile), RFC-konform inkl. folded Header
+    return BytesHeaderParser(policy=compat32).parsebytes(raw, headersonly=True)
+
+def header_block(raw: bytes) -> bytes:
+    # alles bis zum ersten doppelten Zeilenumbruch — auf Bytes, damit nur der Header dekodiert wird
+    idx = raw.find(b"\r\n\r\n")
+    if idx < 0:
+        idx = raw.find(b"\n\n")
+    return raw[:idx] if idx > 0 else raw
 
-def extract_from_msg(path: str) -> str | None:
+def extract_from_msg(stream: BytesIO) -> str | None:
     """
     Versucht verschiedene Wege, um Header aus einer .msg (Outlook) Datei zu extrahieren.
+    Die Datei wird als In-Memory-Stream übergeben (kein Umweg über eine temporäre Datei).
     1) Benutzt extract_msg.Message und prüft mehrere Attribute
     2) Falls nicht vorhanden: versucht, die Rohbytes zu lesen und Header-ähnliche Sektion zu finden
     """
     try:
-        m = extract_msg.Message(path)
+        m = extract_msg.Message(stream)
     except Exception:
         return None
 
@@ -71,10 +83,9 @@ def extract_from_msg(path: str) -> str | None:
     try:
         # some versions expose msg.body or msg.original_message
         if hasattr(m, "raw_msg") and isinstance(m.raw_msg, (bytes, bytearray)):
-            decoded = m.raw_msg.decode("latin1", "ignore")
-            parts = decoded.split("\\n\\n", 1)
-            if parts and parts[0].strip():
-                candidates.append(parts[0])
+            header_bytes = header_block(m.raw_msg)
+            if header_bytes.strip():
+                candidates.append(header_bytes.decode("latin1", "ignore"))
     except Exception:
         pass
 
@@ -83,89 +94,222 @@ def extract_from_msg(path: str) -> str | None:
         candidates = sorted(candidates, key=lambda s: len(s or ""), reverse=True)
         return candidates[0]
 
-    # Fallback: rohdaten aus Datei lesen und Header-Block heuristisch extrahieren
+    # Fallback: Rohdaten aus dem Stream nehmen und Header-Block heuristisch extrahieren
     try:
-        with open(path, "rb") as f:
-            raw = f.read()
-        decoded = raw.decode("latin1", "ignore")
-        # Suche nach einem Bereich, der wie Header aussieht: viele ":" Zeichen und Header-Namen
-        # Wir nehmen alles bis zur ersten doppelten Zeileumbruch
-        parts = re.split(r"\\r?\\n\\r?\\n", decoded, maxsplit=1)
-        if parts and parts[0].strip():
-            return parts[0]
+        header_bytes = header_block(stream.getvalue())
+        if header_bytes.strip():
+            return header_bytes.decode("latin1", "ignore")
     except Exception:
         pass
 
     return None
 
-def parse_headers(headers_text: str) -> dict:
+def dkim_tags(dkim: str) -> dict:
+    """Zerlegt die Tag-Liste einer DKIM-Signatur (RFC 6376: "tag=wert; ...") in einem Durchlauf."""
+    tags = {}
+    for part in dkim.split(";"):
+        name, sep, value = part.partition("=")
+        if sep:
+            # Whitespace (inkl. Faltung) ist in Tag-Werten bedeutungslos
+            tags.setdefault(name.strip(), "".join(value.split()))
+    return tags
+
+def domain_of(value: str) -> str:
+    """Domain der (ersten) Adresse in einem From-/Return-Path-Wert; nimmt den Teil in <...>, falls vorhanden."""
+    s = value.strip()
+    lt = s.find("<")
+    gt = s.find(">", lt + 1)
+    if lt != -1 and gt != -1:
+        s = s[lt + 1:gt]
+    else:
+        # Adressliste "a@b.com, c@d.com": wie parseaddr nur die erste Adresse
+        s = s.split(",", 1)[0]
+    # Kommentare "(...)" entfernen, damit ein "@" darin nicht als Adresse gilt ("j@x.com (C @ sign)")
+    while (c_start := s.find("(")) != -1:
+        c_end = s.find(")", c_start + 1)
+        s = s[:c_start] + (s[c_end + 1:] if c_end != -1 else "")
+    at = s.rfind("@")
+    if at == -1:
+        return ""
+    domain = s[at + 1:]
+    # Domain endet vor Whitespace oder einem Kommentar wie "john@example.com (John)"
+    for i, c in enumerate(domain):
+        if c.isspace() or c in "(),>;":
+            domain = domain[:i]
+            break
+    return domain.lower()
+
+def header_fields(dkim: str | None, from_value: str | None, rp_value: str | None, header_present: bool) -> dict:
     res = {
         "dkim_domain": "",
         "dkim_selector": "",
         "from_domain": "",
         "returnpath_domain": "",
-        "header_present": "yes" if headers_text else "no"
+        "header_present": "yes" if header_present else "no"
     }
 
-    if not headers_text:
-        return res
-
-    # Normalize line endings
-    headers_text = headers_text.replace("\\r\\n", "\\n").replace("\\r", "\\n")
-
-    # DKIM: achte auf folded (mehrzeilige) Header — entferne Einrückungen vor dem Parsen
-    # Wir extrahieren gesamten DKIM-Signature-Header (inkl. folded lines)
-    dkim_match = re.search(r"(?mi)^dkim-signature:\\s*((?:[^\\n]|\\n[ \\t])*)", headers_text)
-    if dkim_match:
-        dkim = dkim_match.group(1)
-        d_match = re.search(r"\\bd=([^;\\s]+)", dkim)
-        s_match = re.search(r"\\bs=([^;\\s]+)", dkim)
-        if d_match:
-            res["dkim_domain"] = d_match.group(1).strip().strip('"')
-        if s_match:
-            res["dkim_selector"] = s_match.group(1).strip().strip('"')
+    if dkim is not None:
+        tags = dkim_tags(dkim)
+        res["dkim_domain"] = tags.get("d", "").strip('"')
+        res["dkim_selector"] = tags.get("s", "").strip('"')
 
     # From
-    fm = re.search(r"(?mi)^from:\\s*(.*)", headers_text)
-    if fm:
-        _, addr = parseaddr(fm.group(1))
-        if "@" in addr:
-            res["from_domain"] = addr.split("@", 1)[1].lower()
+    if from_value is not None:
+        res["from_domain"] = domain_of(from_value)
 
     # Return-Path
-    rp = re.search(r"(?mi)^return-path:\\s*(.*)", headers_text)
-    if rp:
-        _, addr = parseaddr(rp.group(1))
-        if "@" in addr:
-            res["returnpath_domain"] = addr.split("@", 1)[1].lower()
+    if rp_value is not None:
+        res["returnpath_domain"] = domain_of(rp_value)
 
     return res
 
-results = []
+def parse_headers(headers_text: str) -> dict:
+    if not headers_text:
+        return header_fields(None, None, None, False)
+
+    # Vorabprüfung: ohne einen der gesuchten Header-Namen kein Header-Block (z.B. Binärmüll aus dem Fallback)
+    lower_text = headers_text.lower()
+    if not any(tag in lower_text for tag in ("dkim-signature:", "from:", "return-path:")):
+        return header_fields(None, None, None, False)
 
-if uploaded_files:
-    for up in uploaded_files:
-        if up.name.lower().endswith(".eml"):
-            headers = extract_from_eml(up.read())
+    # Normalize line endings
+    headers_text = headers_text.replace("\r\n", "\n").replace("\r", "\n")
+
+    # Ein einziger Durchlauf über die Zeilen; Header-Namen per startswith statt Regex erkennen
+    lines = headers_text.split("\n")
+    wanted = ("dkim-signature:", "from:", "return-path:")
+    found = {}
+    for i, line in enumerate(lines):
+        if line[:1] in (" ", "\t"):
+            # Folgezeile eines folded Headers, kann kein Header-Anfang sein
+            continue
+        lower = line[:20].lower()
+        name = next((n for n in wanted if lower.startswith(n)), None)
+        if name is None or name in found:
+            continue
+        # folded (mehrzeilige) Header — Folgezeilen beginnen mit Leerzeichen/Tab
+        parts = [line[len(name):]]
+        j = i + 1
+        while j < len(lines) and lines[j][:1] in (" ", "\t"):
+            parts.append(lines[j])
+            j += 1
+        found[name] = "\n".join(parts)
+        if len(found) == len(wanted):
+            # alle drei Header gefunden — Rest des Blocks nicht mehr ansehen
+            break
+
+    dkim, from_value, rp_value = (found.get(n) for n in wanted)
+    # Substring-Vorabprüfung ist nur der schnelle Ausstieg; vorhanden sind Header erst, wenn einer gefunden wurde
+    present = dkim is not None or from_value is not None or rp_value is not None
+    return header_fields(dkim, from_value, rp_value, present)
+
+def extract_from_eml(raw: bytes) -> dict:
+    """Liefert die Header-Felder einer EML-Datei; nutzt fast_mail_parser (Rust), falls installiert."""
+    headers = None
+    if _HAVE_FMP:
+        try:
+            em = parse_email(raw)
+        except ParseError:
+            pass
         else:
-            # schreibe temporär die MSG-Datei (extract_msg erwartet einen Pfad)
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".msg") as tmp:
-                tmp.write(up.read())
-                path = tmp.name
-            headers = extract_from_msg(path)
+            headers = {}
+            for name, v in em.headers.items():
+                # fast_mail_parser liefert je Header eine Liste von Werten — wie msg.get() den ersten nehmen
+                if isinstance(v, list):
+                    v = v[0] if v else ""
+                headers.setdefault(name.lower(), v)
+
+    if headers is None:
+        # EML: Felder direkt aus dem geparsten Header-Objekt, kein zweiter Durchlauf über den Text
+        msg = parse_eml(raw)
+        # raw_items() statt msg.get(): compat32 ersetzt 8-Bit-Bytes (z.B. Umlaute in Domains) sonst durch "�";
+        # der Rohwert trägt sie als surrogateescape — als UTF-8 zurückdekodieren, sonst latin1 wie beim MSG-Pfad
+        headers = {}
+        for name, v in msg.raw_items():
+            raw_value = v.encode("ascii", "surrogateescape")
             try:
-                os.remove(path)
-            except Exception:
-                pass
+                v = raw_value.decode("utf-8")
+            except UnicodeDecodeError:
+                v = raw_value.decode("latin1")
+            headers.setdefault(name.lower(), v)
+
+    dkim, from_value, rp_value = (headers.get(n) for n in ("dkim-signature", "from", "return-path"))
+    # wie parse_headers: Header gelten nur als vorhanden, wenn einer der gesuchten Header da ist
+    # (Binärmüll ergibt bei fast_mail_parser sonst ein nicht-leeres Dict)
+    present = dkim is not None or from_value is not None or rp_value is not None
+    return header_fields(dkim, from_value, rp_value, present)
+
+@st.cache_data(show_spinner=False)
+def analyze_bytes(name: str, data: bytes) -> dict:
+    """Extrahiert und parst die Header; gecacht über den Dateiinhalt, damit erneute Uploads nicht neu geparst werden."""
+    if name.lower().endswith(".eml"):
+        return extract_from_eml(data)
+
+    # extract_msg (olefile) liest direkt aus einem dateiähnlichen Objekt
+    headers = extract_from_msg(BytesIO(data))
+    return parse_headers(headers or "")
+
+def read_header_only(up, max_bytes: int = 65536) -> bytes:
+    """Liefert nur den Header-Block der Datei (höchstens max_bytes)."""
+    # getvalue() teilt sich den Puffer mit dem Upload (keine Kopie, unabhängig von der Leseposition);
+    # kopiert wird nur der Header-Ausschnitt
+    data = up.getvalue()
+    for sep in (b"\r\n\r\n", b"\n\n"):
+        idx = data.find(sep, 0, max_bytes)
+        if idx >= 0:
+            return data[:idx + len(sep)]
+    return data[:max_bytes]
+
+def msg_too_large(up) -> bool:
+    # MSG (OLE) muss vollständig gelesen werden — sehr große Dateien überspringen
+    return not up.name.lower().endswith(".eml") and up.size > MAX_MSG_BYTES
+
+def process_one(up) -> dict:
+    """Verarbeitet eine hochgeladene Datei; läuft im Thread-Pool, daher keine UI-Aufrufe."""
+    if up.name.lower().endswith(".eml"):
+        parsed = analyze_bytes(up.name, read_header_only(up))
+    elif msg_too_large(up):
+        # nicht untersucht — im CSV von "keine Header" unterscheidbar halten
+        parsed = {**header_fields(None, None, None, False), "header_present": "skipped"}
+    else:
+        parsed = analyze_bytes(up.name, up.getvalue())
+
+    return {
+        "filename": up.name,
+        **parsed
+    }
+
+if uploaded_files:
+    too_large = [up.name for up in uploaded_files if msg_too_large(up)]
+    if too_large:
+        st.warning(
+            f"Übersprungen (größer als {MAX_MSG_BYTES // (1024 * 1024)} MB): " + ", ".join(too_large)
+        )
 
-        parsed = parse_headers(headers or "")
+    # Dateien parallel verarbeiten; ex.map erhält die Reihenfolge der Uploads
+    with ThreadPoolExecutor(max_workers=min(8, len(uploaded_files))) as ex:
+        results = ex.map(process_one, uploaded_files)
 
-        results.append({
-            "filename": up.name,
-            **parsed
-        })
+        # spaltenweise sammeln statt Zeilen-Dicts — pandas muss keine Spalten pro Zeile ableiten
+        filenames, dkim_domains, dkim_selectors = [], [], []
+        from_domains, returnpath_domains, present = [], [], []
+        for r in results:
+            filenames.append(r["filename"])
+            dkim_domains.append(r["dkim_domain"])
+            dkim_selectors.append(r["dkim_selector"])
+            from_domains.append(r["from_domain"])
+            returnpath_domains.append(r["returnpath_domain"])
+            present.append(r["header_present"])
 
-    df = pd.DataFrame(results)
+    df = pd.DataFrame({
+        "filename": filenames,
+        "dkim_domain": dkim_domains,
+        "dkim_selector": dkim_selectors,
+        "from_domain": from_domains,
+        "returnpath_domain": returnpath_domains,
+        # nur "yes"/"no"/"skipped" — als Kategorie speichersparend
+        "header_present": pd.Categorical(present, categories=["yes", "no", "skipped"]),
+    })
     st.dataframe(df)
 
     st.download_button(